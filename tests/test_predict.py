@@ -0,0 +1,45 @@
+import io
+import struct
+import zlib
+
+import pytest
+from PIL import Image, PngImagePlugin
+
+import predict
+from predict import Predictor
+
+
+def _open(path):
+    with Predictor._mapped(path) as buf:
+        im = Predictor._open(buf, path)
+        im.load()
+        return im
+
+
+def test_small_suffixless_webp_is_identified(tmp_path):
+    # under 2 KB: PcdImagePlugin seeks to byte 2048 while probing
+    path = tmp_path / "upload"
+    Image.new("RGB", (4, 4), "red").save(path, "WEBP")
+    assert path.stat().st_size < 2048
+    assert _open(path).format == "WEBP"
+
+
+def test_mapped_probe_reads_short_like_a_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(predict, "_MMAP_MIN_BYTES", 0)  # force the mmap path
+    path = tmp_path / "upload"
+    Image.new("RGB", (4, 4), "red").save(path, "WEBP")
+    assert _open(path).format == "WEBP"
+
+
+def test_decoder_errors_are_not_masked(tmp_path):
+    # a zTXt chunk that inflates past MAX_TEXT_CHUNK is a PNG decoder error
+    buf = io.BytesIO()
+    Image.new("RGB", (4, 4)).save(buf, "PNG")
+    png = buf.getvalue()
+    data = b"k\0\0" + zlib.compress(b"a" * (PngImagePlugin.MAX_TEXT_CHUNK + 1))
+    chunk = struct.pack(">I", len(data)) + b"zTXt" + data
+    chunk += struct.pack(">I", zlib.crc32(b"zTXt" + data))
+    path = tmp_path / "upload.png"
+    path.write_bytes(png[:33] + chunk + png[33:])  # right after IHDR
+    with pytest.raises(ValueError, match="MAX_TEXT_CHUNK"):
+        _open(path)